@@ -1,25 +1,33 @@
 import aiofiles
+import aiofiles.os
 import aiohttp
 import asyncio
-from base64 import encodebytes
-import binascii
 from bisect import bisect
-from distutils.version import StrictVersion
+import functools
 import io
-from itertools import islice
-import json
 import logging
 import os.path
-import requests
+import re
 import struct
 import voluptuous as vol
 
 from aiohttp import ClientSession
 from homeassistant.const import (
     ATTR_FRIENDLY_NAME, __version__ as current_ha_version)
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.typing import ConfigType
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    from pybase64 import b64decode, b64encode
+except ImportError:
+    from base64 import b64decode, b64encode
+
 _LOGGER = logging.getLogger(__name__)
 
 DOMAIN = 'smartir'
@@ -34,6 +42,8 @@ REMOTE_BASE_URL = (
     "custom_components/smartir/")
 COMPONENT_ABS_DIR = os.path.dirname(
     os.path.abspath(__file__))
+MAX_CONCURRENT_DOWNLOADS = 8
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 CONF_CHECK_UPDATES = 'check_updates'
 CONF_UPDATE_BRANCH = 'update_branch'
@@ -70,77 +80,124 @@ async def async_setup(hass, config):
 
     return True
 
+@functools.lru_cache(maxsize=None)
+def _version_tuple(version):
+    """Return the numeric major.minor.patch of a version string."""
+    parts = (version.split('.') + ['0', '0'])[:3]
+    return tuple(int(re.match(r'\d*', part).group() or 0) for part in parts)
+
+async def _fetch_manifest(hass, session, branch):
+    """Return the manifest of a branch, reusing the cached one if unchanged."""
+    manifests = hass.data.setdefault(DOMAIN, {}).setdefault('manifests', {})
+    etag, data = manifests.get(branch, (None, None))
+    headers = {'If-None-Match': etag} if etag else None
+
+    async with session.get(MANIFEST_URL.format(branch), headers=headers) as response:
+        if response.status == 304:
+            return data
+
+        if response.status != 200:
+            return None
+
+        data = json_loads(await response.read())
+        manifests[branch] = (response.headers.get('ETag'), data)
+        return data
+
 async def _update(hass, branch, do_update=False, notify_if_latest=True):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(MANIFEST_URL.format(branch)) as response:
-                if response.status == 200:
-
-                    data = await response.json(content_type='text/plain')
-                    min_ha_version = data['homeassistant']
-                    last_version = data['updater']['version']
-                    release_notes = data['updater']['releaseNotes']
-
-                    if StrictVersion(last_version) <= StrictVersion(VERSION):
-                        if notify_if_latest:
-                            hass.components.persistent_notification.async_create(
-                                "You're already using the latest version!",
-                                title='SmartIR')
-                        return
-
-                    if StrictVersion(current_ha_version) < StrictVersion(min_ha_version):
-                        hass.components.persistent_notification.async_create(
-                            "There is a new version of SmartIR integration, but it is **incompatible** "
-                            "with your system. Please first update Home Assistant.", title='SmartIR')
-                        return
-
-                    if do_update is False:
-                        hass.components.persistent_notification.async_create(
-                            "A new version of SmartIR integration is available ({}). "
-                            "Call the ``smartir.update_component`` service to update "
-                            "the integration. \n\n **Release notes:** \n{}"
-                            .format(last_version, release_notes), title='SmartIR')
-                        return
-
-                    # Begin update
-                    files = data['updater']['files']
-                    has_errors = False
-
-                    for file in files:
-                        try:
-                            source = REMOTE_BASE_URL.format(branch) + file
-                            dest = os.path.join(COMPONENT_ABS_DIR, file)
-                            os.makedirs(os.path.dirname(dest), exist_ok=True)
-                            await Helper.downloader(source, dest)
-                        except Exception:
-                            has_errors = True
-                            _LOGGER.error("Error updating %s. Please update the file manually.", file)
-
-                    if has_errors:
-                        hass.components.persistent_notification.async_create(
-                            "There was an error updating one or more files of SmartIR. "
-                            "Please check the logs for more information.", title='SmartIR')
-                    else:
-                        hass.components.persistent_notification.async_create(
-                            "Successfully updated to {}. Please restart Home Assistant."
-                            .format(last_version), title='SmartIR')
+        session = async_get_clientsession(hass)
+        data = await _fetch_manifest(hass, session, branch)
+
+        if data is None:
+            return
+
+        min_ha_version = data['homeassistant']
+        last_version = data['updater']['version']
+        release_notes = data['updater']['releaseNotes']
+
+        if _version_tuple(last_version) <= _version_tuple(VERSION):
+            if notify_if_latest:
+                hass.components.persistent_notification.async_create(
+                    "You're already using the latest version!",
+                    title='SmartIR')
+            return
+
+        if _version_tuple(current_ha_version) < _version_tuple(min_ha_version):
+            hass.components.persistent_notification.async_create(
+                "There is a new version of SmartIR integration, but it is **incompatible** "
+                "with your system. Please first update Home Assistant.", title='SmartIR')
+            return
+
+        if do_update is False:
+            hass.components.persistent_notification.async_create(
+                "A new version of SmartIR integration is available ({}). "
+                "Call the ``smartir.update_component`` service to update "
+                "the integration. \n\n **Release notes:** \n{}"
+                .format(last_version, release_notes), title='SmartIR')
+            return
+
+        # Begin update
+        files = data['updater']['files']
+        has_errors = False
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+        async def _download_one(file):
+            async with semaphore:
+                try:
+                    source = REMOTE_BASE_URL.format(branch) + file
+                    dest = os.path.join(COMPONENT_ABS_DIR, file)
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    await Helper.downloader(source, dest, session)
+                except Exception as e:
+                    return file, e
+                return file, None
+
+        results = await asyncio.gather(
+            *[_download_one(file) for file in files])
+
+        for file, error in results:
+            if error is not None:
+                has_errors = True
+                _LOGGER.error("Error updating %s. Please update the file manually.", file)
+
+        if has_errors:
+            hass.components.persistent_notification.async_create(
+                "There was an error updating one or more files of SmartIR. "
+                "Please check the logs for more information.", title='SmartIR')
+        else:
+            hass.components.persistent_notification.async_create(
+                "Successfully updated to {}. Please restart Home Assistant."
+                .format(last_version), title='SmartIR')
     except Exception:
        _LOGGER.error("An error occurred while checking for updates.")
 
 class Helper():
     @staticmethod
-    async def downloader(source, dest):
-        async with aiohttp.ClientSession() as session:
+    async def downloader(source, dest, session=None):
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await Helper.downloader(source, dest, session)
+
+        # stream into a temporary file so a failed download never
+        # truncates the existing one
+        part = dest + '.part'
+        try:
             async with session.get(source) as response:
-                if response.status == 200:
-                    async with aiofiles.open(dest, mode='wb') as f:
-                        await f.write(await response.read())
-                else:
-                    raise Exception("File not found")
+                response.raise_for_status()
+                async with aiofiles.open(part, mode='wb') as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await f.write(chunk)
+            await aiofiles.os.replace(part, dest)
+        except BaseException:
+            try:
+                await aiofiles.os.remove(part)
+            except OSError:
+                pass
+            raise
 
     @staticmethod
     def pronto2lirc(pronto):
-        codes = [int(binascii.hexlify(pronto[i:i+2]), 16) for i in range(0, len(pronto), 2)]
+        codes = struct.unpack_from('>{}H'.format(len(pronto) // 2), pronto)
 
         if codes[0]:
             raise ValueError("Pronto code should start with 0000")
@@ -148,30 +205,27 @@ class Helper():
             raise ValueError("Number of pulse widths does not match the preamble")
 
         frequency = 1 / (codes[1] * 0.241246)
-        return [int(round(code / frequency)) for code in codes[4:]]
+        return [round(code / frequency) for code in codes[4:]]
 
     @staticmethod
     def lirc2broadlink(pulses):
-        array = bytearray()
-
-        for pulse in pulses:
-            pulse = int(pulse * 269 / 8192)
-
-            if pulse < 256:
-                array += bytearray(struct.pack('>B', pulse))
-            else:
-                array += bytearray([0x00])
-                array += bytearray(struct.pack('>H', pulse))
+        pulses = [int(pulse * 269 / 8192) for pulse in pulses]
 
-        packet = bytearray([0x26, 0x00])
-        packet += bytearray(struct.pack('<H', len(array)))
-        packet += array
-        packet += bytearray([0x0d, 0x05])
+        # Pulses below 256 take one byte, longer ones a 0x00 marker and a big-endian word.
+        fmt = '>' + ''.join([('B', 'xH')[pulse > 255] for pulse in pulses])
+        length = struct.calcsize(fmt)
 
         # Add 0s to make ultimate packet size a multiple of 16 for 128-bit AES encryption.
-        remainder = (len(packet) + 4) % 16
+        size = 4 + length + 2
+        remainder = (size + 4) % 16
         if remainder:
-            packet += bytearray(16 - remainder)
+            size += 16 - remainder
+
+        packet = bytearray(size)
+        packet[0] = 0x26
+        struct.pack_into('<H', packet, 2, length)
+        struct.pack_into(fmt, packet, 4, *pulses)
+        packet[4 + length:6 + length] = b'\x0d\x05'
         return packet
 
     @staticmethod
@@ -187,39 +241,37 @@ class Helper():
         (thank you!)
         """
         def decode_broadlink(data):
-            """Generate raw values from broadlink data."""
-            v = iter(data)
-            code = next(v)
-            next(v)  # repeat
-
-            assert code == 0x26  # IR
+            """Return raw values from broadlink data."""
+            assert data[0] == 0x26  # IR
 
-            length = int.from_bytes(islice(v, 2), byteorder="little")
+            length = struct.unpack_from('<H', data, 2)[0]
             assert length >= 3  # a At least trailer
 
-            def decode_iter(x):
-                while True:
-                    try:
-                        d = next(x)
-                    except StopIteration:
-                        return
-                    if d == 0:
-                        d = int.from_bytes(islice(x, 2), byteorder="big")
-
-                    ms = int(round(d * 8192 / 269, 0))
+            payload = data[4 : 4 + length]
+            signal = []
+            pos = 0
+            while pos < len(payload):
+                d = payload[pos]
+                if d:
+                    pos += 1
+                else:
+                    d = int.from_bytes(payload[pos + 1 : pos + 3], byteorder="big")
+                    pos += 3
 
-                    # skip last time interval
-                    if ms > 65535:
-                        return
+                ms = (d * 8192 + 134) // 269  # round(d * 8192 / 269)
 
-                    yield ms
+                # skip last time interval
+                if ms > 65535:
+                    break
 
-            yield from decode_iter(islice(v, length))
+                signal.append(ms)
 
-            rem = list(v)
+            rem = list(data[4 + min(pos, len(payload)) :])
             if any(rem):
                 _LOGGER.warning("Ignored extra data: %s", rem)
 
+            return signal
+
         def encode_tuya(signal, compression_level):
             """
             Encodes an IR signal
@@ -282,9 +334,32 @@ class Helper():
                     return next((c for c in find_length_candidates() if c[0] >= 3), None)
 
                 def find_length_max():
-                    return max(find_length_candidates(), key=lambda c: (c[0], -c[1]), default=None)
+                    # candidates come closest first, so the first longest one wins
+                    best = None
+                    limit = min(L, len(data) - pos)
+                    for d in distance_candidates():
+                        length = find_length_for_distance(pos - d)
+                        if best is None or length > best[0]:
+                            best = (length, d)
+                            if length == limit:
+                                break
+                    return best
+
+                if level == 2:
+                    chains = {}  # 3-byte prefix -> positions, oldest first
+                    next_pos = 0
+
+                    def distance_candidates():
+                        nonlocal next_pos
+                        while next_pos < pos:
+                            chains.setdefault(data[next_pos : next_pos + 3], []).append(next_pos)
+                            next_pos += 1
+                        for p in reversed(chains.get(data[pos : pos + 3], ())):
+                            if pos - p > W:
+                                break
+                            yield pos - p  # closest first
 
-                if level >= 2:
+                if level >= 3:
                     suffixes = []
                     next_pos = 0
 
@@ -301,8 +376,8 @@ class Helper():
                                 suffixes.pop(find_idx(next_pos - W))
                             suffixes.insert(idx := find_idx(next_pos), next_pos)
                             next_pos += 1
-                        idxs = (idx + i for i in (+1, -1))  # try +1 first
-                        return (pos - suffixes[i] for i in idxs if 0 <= i < len(suffixes))
+                        idxs = (idx + i for i in (+1, -1))
+                        return sorted(pos - suffixes[i] for i in idxs if 0 <= i < len(suffixes))  # closest first
 
                 if level <= 2:
                     find_length = {1: find_length_cheap, 2: find_length_max}[level]
@@ -348,12 +423,12 @@ class Helper():
                     else:
                         emit_distance_block(out, length, distance)
 
-            payload = b"".join(struct.pack("<H", t) for t in signal)
+            payload = struct.pack(f"<{len(signal)}H", *signal)
             compress(out := io.BytesIO(), payload, compression_level)
             payload = out.getvalue()
-            return encodebytes(payload).decode("ascii").replace("\n", "")
+            return b64encode(payload).decode("ascii")
 
-        raw_data = list(decode_broadlink(data))
+        raw_data = decode_broadlink(data)
 
         _LOGGER.info("Raw data: %s", raw_data)
 
@@ -14,6 +14,7 @@ from homeassistant.const import (
     PRECISION_TENTHS, PRECISION_HALVES, PRECISION_WHOLE)
 from homeassistant.core import Event, EventStateChangedData, callback
 from homeassistant.helpers.event import async_track_state_change, async_track_state_change_event
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.restore_state import RestoreEntity
 from . import COMPONENT_ABS_DIR, Helper
@@ -74,7 +75,8 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
                             "smartHomeHub/SmartIR/master/"
                             "codes/climate/{}.json")
 
-            await Helper.downloader(codes_source.format(device_code), device_json_path)
+            await Helper.downloader(codes_source.format(device_code), device_json_path,
+                                    async_get_clientsession(hass))
         except Exception:
             _LOGGER.error("There was an error while downloading the device Json file. " \
                           "Please check your internet connection or if the device code " \
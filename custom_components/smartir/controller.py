@@ -1,12 +1,15 @@
 from abc import ABC, abstractmethod
+import aiohttp
 import asyncio
-from base64 import b64encode, b64decode
 import binascii
+import functools
+import itertools
+import struct
 from homeassistant.components.zha.websocket_api import (
         IEEE_SCHEMA
 )
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 import homeassistant.helpers.config_validation as cv
-import requests
 from typing import Any
 import voluptuous as vol
 from zha.application.const import (
@@ -23,12 +26,12 @@ from zha.application.const import (
     CLUSTER_TYPE_IN,
     CLUSTER_TYPE_OUT
 )
+from yarl import URL
 from zigpy.types.named import EUI64
 import logging
-import json
 
 from homeassistant.const import ATTR_ENTITY_ID
-from . import Helper
+from . import Helper, b64decode, b64encode, json_loads
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -44,12 +47,14 @@ ENC_HEX = 'Hex'
 ENC_PRONTO = 'Pronto'
 ENC_RAW = 'Raw'
 
-BROADLINK_COMMANDS_ENCODING = [ENC_BASE64, ENC_HEX, ENC_PRONTO]
-XIAOMI_COMMANDS_ENCODING = [ENC_PRONTO, ENC_RAW]
-MQTT_COMMANDS_ENCODING = [ENC_RAW]
-LOOKIN_COMMANDS_ENCODING = [ENC_PRONTO, ENC_RAW]
-ESPHOME_COMMANDS_ENCODING = [ENC_RAW]
-ZHA_TUYA_BROADLINK_COMMANDS_ENCODING = [ENC_BASE64, ENC_HEX, ENC_PRONTO, ENC_RAW]
+BROADLINK_COMMANDS_ENCODING = frozenset((ENC_BASE64, ENC_HEX, ENC_PRONTO))
+XIAOMI_COMMANDS_ENCODING = frozenset((ENC_PRONTO, ENC_RAW))
+MQTT_COMMANDS_ENCODING = frozenset((ENC_RAW,))
+LOOKIN_COMMANDS_ENCODING = frozenset((ENC_PRONTO, ENC_RAW))
+ESPHOME_COMMANDS_ENCODING = frozenset((ENC_RAW,))
+ZHA_TUYA_BROADLINK_COMMANDS_ENCODING = frozenset((ENC_BASE64, ENC_HEX, ENC_PRONTO, ENC_RAW))
+
+LOOKIN_REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=5)
 
 CONF_ZHA_TUYA_BROADLINK_IEEE = "tuya-broadlink-ieee"
 CONF_ENDPOINT_ID = ATTR_ENDPOINT_ID
@@ -58,14 +63,18 @@ CONF_CLUSTER_TYPE = ATTR_CLUSTER_TYPE
 CONF_COMMAND = ATTR_COMMAND
 CONF_COMMAND_TYPE = ATTR_COMMAND_TYPE
 CONF_MANUFACTURER = ATTR_MANUFACTURER
+CONF_PARALLEL = 'parallel'
+CONF_BATCH_MS = 'batch_ms'
+
+BROADLINK_BATCH_MAX = 8
+ZHA_MAX_CONCURRENT_CALLS = 4
 
 ZHA_TUYA_BROADLINK_SERVICE_DATA_DEFAULTS = {
     ATTR_ENDPOINT_ID: 1,
     ATTR_CLUSTER_ID: 0xe004,
     ATTR_CLUSTER_TYPE: CLUSTER_TYPE_IN,
     ATTR_COMMAND: 2,
-    ATTR_COMMAND_TYPE: CLUSTER_COMMAND_SERVER,
-    ATTR_PARAMS: {}
+    ATTR_COMMAND_TYPE: CLUSTER_COMMAND_SERVER
 }
 
 # allow the renaming of configuration attributes for future evolutions (ie. ZHA, not tuya)
@@ -92,14 +101,24 @@ ZHA_TUYA_BROADLINK_CONTROLLER_DATA_SCHEMA = vol.Schema(
         vol.Optional(CONF_MANUFACTURER): vol.All(
             vol.Coerce(int), vol.Range(min=-1)
         ),
+        vol.Optional(CONF_PARALLEL): cv.boolean,
+    },
+)
+
+BROADLINK_CONTROLLER_DATA_SCHEMA = vol.Schema(
+    {
+        vol.Required(ATTR_ENTITY_ID): cv.entity_id,
+        vol.Optional(CONF_BATCH_MS): cv.positive_int,
     },
 )
 
 CONTROLLER_DATA_SCHEMA = vol.Union(
     ZHA_TUYA_BROADLINK_CONTROLLER_DATA_SCHEMA,
+    BROADLINK_CONTROLLER_DATA_SCHEMA,
     vol.Schema(cv.string),
     msg=f"""value should be a string
-or a dictionary with at least the '{CONF_ZHA_TUYA_BROADLINK_IEEE}' device address\n"""
+or a dictionary with at least the '{CONF_ZHA_TUYA_BROADLINK_IEEE}' device address
+or the '{ATTR_ENTITY_ID}' of a Broadlink remote\n"""
 )
 
 def cv_controller_data(value: Any) -> Any:
@@ -108,34 +127,83 @@ def cv_controller_data(value: Any) -> Any:
     _LOGGER.debug("Valid 'controller_data' value is: %s", str(value))
     return value
 
-def get_controller(hass, controller, encoding, controller_data, delay):
-    """Return a controller compatible with the specification provided."""
-    controllers = {
-        BROADLINK_CONTROLLER: BroadlinkController,
-        XIAOMI_CONTROLLER: XiaomiController,
-        MQTT_CONTROLLER: MQTTController,
-        LOOKIN_CONTROLLER: LookinController,
-        ESPHOME_CONTROLLER: ESPHomeController,
-        ZHA_TUYA_BROADLINK_CONTROLLER: ZHATuyaBroadlinkController
-    }
+# errors raised by the conversion helpers on a malformed command
+_CONVERSION_ERRORS = (ValueError, TypeError, AssertionError, IndexError, struct.error)
+
+@functools.lru_cache(maxsize=512)
+def _parse_json(command):
+    """Parse a JSON command, once per distinct command."""
+    return json_loads(command)
+
+def _unchanged(command):
+    """Return the command as is."""
+    return command
+
+def _pronto_to_broadlink(command):
+    """Convert a Pronto command to a Broadlink packet."""
+    command = bytes.fromhex(command)
+    command = Helper.pronto2lirc(command)
+    return bytes(Helper.lirc2broadlink(command))
+
+def _hex_to_base64(command):
+    """Convert a Hex command to the Base64 encoding."""
     try:
-        if controller in (BROADLINK_CONTROLLER, ZHA_TUYA_BROADLINK_CONTROLLER):
-            if isinstance(controller_data, dict) and CONF_ZHA_TUYA_BROADLINK_IEEE in controller_data:
-                controller = ZHA_TUYA_BROADLINK_CONTROLLER
-        return controllers[controller](hass, controller, encoding, controller_data, delay)
-    except KeyError:
-        raise Exception("The controller is not supported.")
+        command = binascii.unhexlify(command)
+        return b64encode(command).decode('utf-8')
+    except _CONVERSION_ERRORS as e:
+        raise ValueError("Error while converting "
+                         "Hex to Base64 encoding") from e
+
+def _pronto_to_base64(command):
+    """Convert a Pronto command to the Base64 encoding."""
+    try:
+        command = _pronto_to_broadlink(command)
+        return b64encode(command).decode('utf-8')
+    except _CONVERSION_ERRORS as e:
+        raise ValueError("Error while converting "
+                         "Pronto to Base64 encoding") from e
+
+def _base64_to_tuya(command):
+    """Convert a Base64 command to the Tuya encoding."""
+    try:
+        command = b64decode(command)
+        return Helper.broadlink2tuya(command)
+    except _CONVERSION_ERRORS as e:
+        raise ValueError("Error while converting "
+                         "Base64 to Tuya encoding") from e
+
+def _hex_to_tuya(command):
+    """Convert a Hex command to the Tuya encoding."""
+    try:
+        command = binascii.unhexlify(command)
+        return Helper.broadlink2tuya(command)
+    except _CONVERSION_ERRORS as e:
+        raise ValueError("Error while converting "
+                         "Hex to Tuya encoding") from e
+
+def _pronto_to_tuya(command):
+    """Convert a Pronto command to the Tuya encoding."""
+    try:
+        command = _pronto_to_broadlink(command)
+        return Helper.broadlink2tuya(command)
+    except _CONVERSION_ERRORS as e:
+        raise ValueError("Error while converting "
+                         "Pronto to Tuya encoding") from e
 
 
 class AbstractController(ABC):
     """Representation of a controller."""
+
+    __slots__ = ('hass', '_controller', '_encoding', '_controller_data', '_delay')
+
     def __init__(self, hass, controller, encoding, controller_data, delay):
         self.check_encoding(encoding)
         self.hass = hass
         self._controller = controller
         self._encoding = encoding
         self._controller_data = controller_data
-        self._delay = delay
+        # the fan, light and media player platforms pass the delay as a string
+        self._delay = float(delay)
 
     @abstractmethod
     def check_encoding(self, encoding):
@@ -148,9 +216,120 @@ class AbstractController(ABC):
         pass
 
 
+class _BroadlinkBatch():
+    """Coalesces the commands sent to one Broadlink remote in a short window."""
+
+    _batches = {}
+
+    def __init__(self, hass, entity_id, window):
+        self._hass = hass
+        self._key = (entity_id, window)
+        self._entity_id = entity_id
+        self._window = window
+        self._pending = []
+        self._full = asyncio.Event()
+        self._task = None
+
+    @classmethod
+    def get(cls, hass, entity_id, window):
+        """Return the batch of a Broadlink remote, creating it on first use."""
+        batch = cls._batches.get((entity_id, window))
+        if batch is None or batch._hass is not hass:
+            batch = cls._batches[(entity_id, window)] = cls(hass, entity_id, window)
+        return batch
+
+    async def async_send(self, commands, delay):
+        """Queue commands and wait until they have been sent."""
+        future = self._hass.loop.create_future()
+        entry = (commands, delay, future)
+        self._pending.append(entry)
+
+        if len(self._pending) >= BROADLINK_BATCH_MAX:
+            self._full.set()
+        if self._task is None:
+            self._task = self._hass.async_create_task(self._async_flush())
+            self._task.add_done_callback(self._flush_done)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # not flushed yet, the commands must not be sent anymore
+            self._pending = [p for p in self._pending if p is not entry]
+            raise
+
+    async def _async_flush(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), self._window)
+        except asyncio.TimeoutError:
+            pass
+
+        pending, self._pending = self._pending, []
+        self._full.clear()
+        self._task = None
+
+        try:
+            # commands queued with different delays can't share a call
+            for delay, group in itertools.groupby(pending, key=lambda p: p[1]):
+                group = list(group)
+                service_data = {
+                    ATTR_ENTITY_ID: self._entity_id,
+                    'command':  [c for commands, _, _ in group for c in commands],
+                    'delay_secs': delay
+                }
+
+                try:
+                    await self._hass.services.async_call(
+                        'remote', 'send_command', service_data)
+                except Exception as e:
+                    for _, _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, _, future in group:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            # only left unresolved when the flush gets cancelled midway
+            for _, _, future in pending:
+                future.cancel()
+
+    def _flush_done(self, task):
+        if self._task is task:
+            # cancelled before it could take the queued commands
+            pending, self._pending = self._pending, []
+            self._full.clear()
+            self._task = None
+            for _, _, future in pending:
+                future.cancel()
+
+        if not self._pending and self._batches.get(self._key) is self:
+            del self._batches[self._key]
+
+
 class BroadlinkController(AbstractController):
     """Controls a Broadlink device."""
 
+    __slots__ = ('_entity_id', '_batch_window', '_codes', '_encode')
+
+    _ENCODERS = {
+        ENC_BASE64: _unchanged,
+        ENC_HEX: _hex_to_base64,
+        ENC_PRONTO: _pronto_to_base64
+    }
+
+    def __init__(self, hass, controller, encoding, controller_data, delay):
+        super().__init__(hass, controller, encoding, controller_data, delay)
+
+        if isinstance(controller_data, dict):
+            self._entity_id = controller_data[ATTR_ENTITY_ID]
+            self._batch_window = controller_data.get(CONF_BATCH_MS, 0) / 1000
+        else:
+            self._entity_id = controller_data
+            self._batch_window = 0
+
+        self._codes = {}
+        self._encode = self._ENCODERS[encoding]
+
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         if encoding not in BROADLINK_COMMANDS_ENCODING:
@@ -165,29 +344,19 @@ class BroadlinkController(AbstractController):
             command = [command]
 
         for _command in command:
-            if self._encoding == ENC_HEX:
-                try:
-                    _command = binascii.unhexlify(_command)
-                    _command = b64encode(_command).decode('utf-8')
-                except:
-                    raise Exception("Error while converting "
-                                    "Hex to Base64 encoding")
-
-            if self._encoding == ENC_PRONTO:
-                try:
-                    _command = _command.replace(' ', '')
-                    _command = bytearray.fromhex(_command)
-                    _command = Helper.pronto2lirc(_command)
-                    _command = Helper.lirc2broadlink(_command)
-                    _command = b64encode(_command).decode('utf-8')
-                except:
-                    raise Exception("Error while converting "
-                                    "Pronto to Base64 encoding")
+            code = self._codes.get(_command)
+            if code is None:
+                code = self._codes[_command] = 'b64:' + self._encode(_command)
+            commands.append(code)
 
-            commands.append('b64:' + _command)
+        if self._batch_window:
+            await _BroadlinkBatch.get(
+                self.hass, self._entity_id, self._batch_window
+            ).async_send(commands, self._delay)
+            return
 
         service_data = {
-            ATTR_ENTITY_ID: self._controller_data,
+            ATTR_ENTITY_ID: self._entity_id,
             'command':  commands,
             'delay_secs': self._delay
         }
@@ -199,6 +368,12 @@ class BroadlinkController(AbstractController):
 class XiaomiController(AbstractController):
     """Controls a Xiaomi device."""
 
+    __slots__ = ('_prefix',)
+
+    def __init__(self, hass, controller, encoding, controller_data, delay):
+        super().__init__(hass, controller, encoding, controller_data, delay)
+        self._prefix = encoding.lower() + ':'
+
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         if encoding not in XIAOMI_COMMANDS_ENCODING:
@@ -209,7 +384,7 @@ class XiaomiController(AbstractController):
         """Send a command."""
         service_data = {
             ATTR_ENTITY_ID: self._controller_data,
-            'command':  self._encoding.lower() + ':' + command
+            'command':  self._prefix + command
         }
 
         await self.hass.services.async_call(
@@ -219,6 +394,8 @@ class XiaomiController(AbstractController):
 class MQTTController(AbstractController):
     """Controls a MQTT device."""
 
+    __slots__ = ()
+
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         if encoding not in MQTT_COMMANDS_ENCODING:
@@ -239,6 +416,14 @@ class MQTTController(AbstractController):
 class LookinController(AbstractController):
     """Controls a Lookin device."""
 
+    __slots__ = ('_session', '_url')
+
+    def __init__(self, hass, controller, encoding, controller_data, delay):
+        super().__init__(hass, controller, encoding, controller_data, delay)
+        self._session = async_get_clientsession(hass)
+        encoding = encoding.lower().replace('pronto', 'prontohex')
+        self._url = URL(f"http://{self._controller_data}") / 'commands' / 'ir' / encoding
+
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         if encoding not in LOOKIN_COMMANDS_ENCODING:
@@ -247,15 +432,17 @@ class LookinController(AbstractController):
 
     async def send(self, command):
         """Send a command."""
-        encoding = self._encoding.lower().replace('pronto', 'prontohex')
-        url = f"http://{self._controller_data}/commands/ir/" \
-                f"{encoding}/{command}"
-        await self.hass.async_add_executor_job(requests.get, url)
+        async with self._session.get(
+                self._url / command,
+                timeout=LOOKIN_REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
 
 
 class ESPHomeController(AbstractController):
     """Controls a ESPHome device."""
 
+    __slots__ = ()
+
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         if encoding not in ESPHOME_COMMANDS_ENCODING:
@@ -264,7 +451,7 @@ class ESPHomeController(AbstractController):
 
     async def send(self, command):
         """Send a command."""
-        service_data = {'command':  json.loads(command)}
+        service_data = {'command':  _parse_json(command)}
 
         await self.hass.services.async_call(
             'esphome', self._controller_data, service_data)
@@ -273,60 +460,107 @@ class ESPHomeController(AbstractController):
 class ZHATuyaBroadlinkController(AbstractController):
     """Controls a Zigbee 3.0 Tuya device using ZHA."""
 
+    __slots__ = ('_service_data', '_parallel', '_calls', '_codes', '_encode')
+
+    _ENCODERS = {
+        ENC_BASE64: _base64_to_tuya,
+        ENC_HEX: _hex_to_tuya,
+        ENC_PRONTO: _pronto_to_tuya,
+        ENC_RAW: _unchanged
+    }
+
     def __init__(self, hass, controller, encoding, controller_data, delay):
         super().__init__(hass, controller, encoding, controller_data, delay)
 
         self._service_data = dict(ZHA_TUYA_BROADLINK_SERVICE_DATA_DEFAULTS)
         for kc, v in self._controller_data.items():
+            if kc == CONF_PARALLEL:
+                continue
             ks = ZHA_TUYA_BROADLINK_SERVICE_DATA_FROM_CONF[kc]
             self._service_data[ks] = v 
 
+        self._parallel = self._controller_data.get(CONF_PARALLEL, False)
+        self._calls = asyncio.Semaphore(ZHA_MAX_CONCURRENT_CALLS)
+
+        self._codes = {}
+        self._encode = self._ENCODERS[encoding]
+
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         if encoding not in ZHA_TUYA_BROADLINK_COMMANDS_ENCODING:
             raise Exception("The encoding is not supported "
                             "by the ZHATuya Broadlink controller.")
 
+    async def _async_encode(self, command):
+        """Return the Tuya code of a command, converting it on first use."""
+        code = self._codes.get(command)
+        if code is None:
+            # the Tuya compression is CPU bound, keep it off the event loop
+            code = await self.hass.async_add_executor_job(
+                self._encode, command)
+            self._codes[command] = code
+        return code
+
+    async def _async_call(self, code, offset=0):
+        """Issue the ZHA cluster command carrying a Tuya code."""
+        if offset:
+            await asyncio.sleep(offset)
+
+        service_data = {**self._service_data, ATTR_PARAMS: {'code': code}}
+
+        _LOGGER.debug("Calling service 'zha.issue_zigbee_cluster_command'\nwith 'service_data': %s",
+                      str(service_data))
+
+        async with self._calls:
+            await self.hass.services.async_call(
+                'zha', 'issue_zigbee_cluster_command', service_data)
+
     async def send(self, command):
         """Send a command."""
         if not isinstance(command, list):
             command = [command]
 
-        service_data = dict(self._service_data)
+        codes = [await self._async_encode(_command) for _command in command]
 
-        for _command in command:
-            if self._encoding == ENC_BASE64:
-                try:
-                    _command = b64decode(_command)
-                    _command = Helper.broadlink2tuya(_command)
-                except:
-                    raise Exception("Error while converting "
-                                    "Base64 to Tuya encoding")
+        if self._delay <= 0 or self._parallel:
+            # start each command at its slot instead of after the previous one returns
+            await asyncio.gather(*[self._async_call(code, i * self._delay)
+                                   for i, code in enumerate(codes)])
+            return
 
-            if self._encoding == ENC_HEX:
-                try:
-                    _command = binascii.unhexlify(_command)
-                    _command = Helper.broadlink2tuya(_command)
-                except:
-                    raise Exception("Error while converting "
-                                    "Hex to Tuya encoding")
+        for i, code in enumerate(codes):
+            if i:
+                await asyncio.sleep(self._delay)
+            await self._async_call(code)
 
-            if self._encoding == ENC_PRONTO:
-                try:
-                    _command = _command.replace(' ', '')
-                    _command = bytearray.fromhex(_command)
-                    _command = Helper.pronto2lirc(_command)
-                    _command = Helper.lirc2broadlink(_command)
-                    _command = Helper.broadlink2tuya(_command)
-                except:
-                    raise Exception("Error while converting "
-                                    "Pronto to Tuya encoding")
 
-            service_data[ATTR_PARAMS]['code'] = _command
+_CONTROLLERS = {
+    BROADLINK_CONTROLLER: BroadlinkController,
+    XIAOMI_CONTROLLER: XiaomiController,
+    MQTT_CONTROLLER: MQTTController,
+    LOOKIN_CONTROLLER: LookinController,
+    ESPHOME_CONTROLLER: ESPHomeController,
+    ZHA_TUYA_BROADLINK_CONTROLLER: ZHATuyaBroadlinkController
+}
 
-            _LOGGER.debug("Calling service 'zha.issue_zigbee_cluster_command'\nwith 'service_data': %s",
-                          str(service_data))
+_TUYA_CAPABLE = frozenset((BROADLINK_CONTROLLER, ZHA_TUYA_BROADLINK_CONTROLLER))
 
-            await self.hass.services.async_call(
-                'zha', 'issue_zigbee_cluster_command', service_data)
-            await asyncio.sleep(self._delay)
+def get_controller(hass, controller, encoding, controller_data, delay):
+    """Return a controller compatible with the specification provided."""
+    if (controller in _TUYA_CAPABLE and isinstance(controller_data, dict)
+            and CONF_ZHA_TUYA_BROADLINK_IEEE in controller_data):
+        controller = ZHA_TUYA_BROADLINK_CONTROLLER
+
+    controller_class = _CONTROLLERS.get(controller)
+    if controller_class is None:
+        raise Exception("The controller is not supported.")
+
+    # a dictionary holds either a Broadlink remote or a ZHA Tuya device
+    if isinstance(controller_data, dict) and not (
+            controller == BROADLINK_CONTROLLER
+            or (controller == ZHA_TUYA_BROADLINK_CONTROLLER
+                and CONF_ZHA_TUYA_BROADLINK_IEEE in controller_data)):
+        raise Exception("The controller data is not supported "
+                        "by the controller.")
+
+    return controller_class(hass, controller, encoding, controller_data, delay)
@@ -20,6 +20,7 @@ from homeassistant.const import (
 )
 from homeassistant.core import callback
 from homeassistant.helpers.event import async_track_state_change_event
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.restore_state import RestoreEntity
 from . import COMPONENT_ABS_DIR, Helper
@@ -89,6 +90,7 @@ async def async_setup_platform(
             await Helper.downloader(
                 codes_source.format(device_code),
                 device_json_path,
+                async_get_clientsession(hass),
             )
         except Exception:
             _LOGGER.error(
@@ -12,6 +12,7 @@ from homeassistant.components.media_player.const import (
     MediaPlayerEntityFeature, MediaType)
 from homeassistant.const import (
     CONF_NAME, STATE_OFF, STATE_ON, STATE_UNKNOWN)
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.restore_state import RestoreEntity
 from . import COMPONENT_ABS_DIR, Helper
@@ -63,7 +64,8 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
                             "smartHomeHub/SmartIR/master/"
                             "codes/media_player/{}.json")
 
-            await Helper.downloader(codes_source.format(device_code), device_json_path)
+            await Helper.downloader(codes_source.format(device_code), device_json_path,
+                                    async_get_clientsession(hass))
         except Exception:
             _LOGGER.error("There was an error while downloading the device Json file. " \
                           "Please check your internet connection or if the device code " \